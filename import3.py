@@ -1,8 +1,12 @@
-import requests
+import httpx
+import orjson
 import pandas as pd
 import google.generativeai as genai
 from dotenv import load_dotenv
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field, fields
 import random
 import string
 import streamlit as st
@@ -31,7 +35,12 @@ if not GEMINI_API_KEY:
     st.error("找不到 Gemini API 金鑰，請確保已設定環境變數 GEMINI_API_KEY")
     st.stop()
 
-genai.configure(api_key=GEMINI_API_KEY)
+@st.cache_resource
+def _configure_genai(api_key):
+    """設定 Gemini API 金鑰，每個程序只執行一次"""
+    genai.configure(api_key=api_key)
+
+_configure_genai(GEMINI_API_KEY)
 
 # API URLs
 api_urls = {
@@ -40,9 +49,8 @@ api_urls = {
     "finance": "https://openapi.twse.com.tw/v1/opendata/t187ap06_L_ci"
 }
 
-# 需要的財報欄位
+# 需要的財報欄位（股票代號欄位已在 _fetch_table 統一）
 required_columns = {
-    "公司代號": "股票代號",
     "年度": "財報年度",
     "季別": "財報季度",
     "營業收入": "營業額",
@@ -58,31 +66,169 @@ required_columns = {
     "MonthlyAveragePrice": "月均價"
 }
 
-@st.cache_data(ttl=3600)  # 快取資料1小時
-def fetch_data(stock_id):
-    """擷取財務數據並存入 DataFrame"""
-    data_frames = {}
+# 清除數值字串中的千分位逗號與百分比符號
+_NUM_STRIP = str.maketrans('', '', ',%')
+
+# 證交所 API 暫時性錯誤的重試設定
+_MAX_RETRIES = 2
+_RETRY_BACKOFF = 0.3
+_RETRY_STATUS = (500, 502, 503, 504)
+
+# 分析重點對應的提示詞
+_FOCUS_PROMPTS = {
+    "獲利": "請著重分析公司的獲利能力、ROE和EPS趨勢，評估公司的盈利品質和持續性。",
+    "風險": "請詳細評估投資風險，包括估值風險、產業風險、財務風險和地緣政治風險。特別關注本益比和股價淨值比是否合理。",
+    "成長": "請分析公司的成長潛力、未來發展機會和產業趨勢。評估公司的競爭優勢和市場擴張能力。",
+    "股利": "請著重分析公司的股利政策、殖利率表現和股利發放穩定性。評估股利成長潛力和可持續性。",
+    "積極投資": "請以積極投資者的視角分析，著重於成長機會、市場擴張潛力和可能的股價催化劑。忽略短期波動風險，專注於長期高回報可能性。提供更進取的投資建議和時機點判斷。"
+}
+
+# 將選項映射到API參數
+_FOCUS_MAPPING = {
+    "全面分析": None,
+    "獲利": "獲利",
+    "風險": "風險",
+    "成長": "成長",
+    "股利": "股利",
+    "積極投資": "積極投資"
+}
+
+# 關鍵財務數據欄位
+_CRITICAL_FIELDS = ["稅後淨利", "EPS", "ROE", "收盤價"]
+
+# 關鍵財務數據異常時的警告文字
+_CRITICAL_WARNING = "⚠️ 警告：部分關鍵財務數據（如稅後淨利、EPS、ROE或收盤價）為零或異常，分析結果可能不準確。"
+
+# AI 解析提示詞範本，於載入時建立一次，每次分析只需代入數值
+_PROMPT_TMPL = """
+    # 財務分析請求
+    
+    ## 公司基本資料
+    - 公司: {公司名稱} ({股票代號})
+    
+    ## 財務數據摘要
+    - 營業額: {營業額:,.1f} 元
+    - 稅後淨利: {稅後淨利:,.1f} 元
+    - 每股盈餘 (EPS): {EPS:.1f}
+    - 股東權益報酬率 (ROE): {ROE:.1f}%
+    - 本益比 (P/E Ratio): {本益比:.1f}
+    - 殖利率 (Dividend Yield): {殖利率:.1f}%
+    - 股價淨值比 (P/B Ratio): {股價淨值比:.1f}
+    - 收盤價: {收盤價:,.2f} 元
+    - 月均價: {月均價:,.2f} 元
+    
+    {missing_warning}
+    {critical_warning}
+    
+    ## 分析重點
+    {focus_instruction}
+    
+    ## 分析要求
+    1. 請以繁體中文回覆
+    2. 請提供結構化分析報告，包含以下部分：
+       - 優勢分析
+       - 潛在風險和需注意的點
+       - 未來趨勢與投資建議
+       - 總結
+    3. 使用表情符號增加可讀性
+    4. 如果數據存在異常或缺失，請在分析中指出並解釋可能的影響
+    5. 請客觀分析，避免過度樂觀或悲觀的偏見
+    """
 
-    for key in api_urls:
+# 關鍵財務數據缺失時，取代 AI 報告的本地摘要範本
+_INSUFFICIENT_DATA_TMPL = """
+### ⚠️ 數據不足無法分析
+
+{公司名稱} ({股票代號}) 缺少關鍵財務數據（{critical_missing}），為避免產生不準確的報告，已略過 AI 分析。
+
+{missing_warning}
+
+如仍要進行 AI 分析，請勾選側邊欄的「仍要AI分析」。
+"""
+
+@st.cache_resource
+def _twse_client():
+    """建立證交所 API 共用的連線客戶端"""
+    # 三個 API 位於同一主機，共用一個客戶端可跨查詢重複使用 TLS 連線，
+    # HTTP/2 下所有請求可在同一條連線上多工傳輸；重試統一由 _fetch_json 處理
+    transport = httpx.HTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_connections=4, max_keepalive_connections=4)
+    )
+    return httpx.Client(
+        transport=transport,
+        timeout=15,
+        headers={"Accept-Encoding": "gzip"}
+    )
+
+def _fetch_json(url):
+    """擷取單一 API 的 JSON 資料，連線失敗、回應逾時或伺服器暫時錯誤時退避重試"""
+    client = _twse_client()
+    for attempt in range(_MAX_RETRIES + 1):
         try:
-            response = requests.get(api_urls[key])
-            if response.status_code == 200:
-                df = pd.DataFrame(response.json())
+            response = client.get(url)
+        except httpx.TransportError:
+            # 連線失敗、讀取逾時、連線中斷等傳輸錯誤，最後一次仍失敗則拋出
+            if attempt == _MAX_RETRIES:
+                raise
+        else:
+            if response.status_code not in _RETRY_STATUS or attempt == _MAX_RETRIES:
+                break
+        time.sleep(_RETRY_BACKOFF * 2 ** attempt)
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+def _stock_id_column(rows):
+    """判斷 API 資料中代表股票代號的欄位"""
+    for col in ("公司代號", "Code", "股票代號"):
+        if col in rows[0]:
+            return col
+    raise ValueError("資料中找不到股票代號欄位")
 
-                if "公司代號" in df.columns:
-                    df.rename(columns={"公司代號": "股票代號"}, inplace=True)
-                
-                if "Code" in df.columns:
-                    df.rename(columns={"Code": "股票代號"}, inplace=True)
+# 每個 API 各自快取全市場資料1小時，失敗時拋出例外不會被快取；
+# 以 cache_resource 共用同一份索引，查詢時不必反序列化整個市場的資料列，
+# 呼叫端只能讀取不可修改
+@st.cache_resource(ttl=3600)
+def _fetch_table(key) -> dict[str, list[dict]]:
+    """擷取單一 API 的全市場數據，並依股票代號建立唯讀索引供所有查詢共用"""
+    rows = _fetch_json(api_urls[key])
+    if not isinstance(rows, list):
+        raise ValueError("回傳資料格式不正確")
 
-                df.rename(columns=required_columns, inplace=True, errors='ignore')
-                df = df[df["股票代號"].astype(str) == stock_id]
+    # 直接在 JSON 層級分組，查詢時不必建立整個市場的 DataFrame；
+    # 股票代號在此統一為字串欄位，後續步驟不需再轉型
+    rows_by_id = {}
+    if rows:
+        id_col = _stock_id_column(rows)
+        for row in rows:
+            stock_id = str(row.pop(id_col, None))
+            row["股票代號"] = stock_id
+            rows_by_id.setdefault(stock_id, []).append(row)
 
-                if not df.empty:
-                    data_frames[key] = df
+    return rows_by_id
 
+def fetch_data(stock_id):
+    """從快取的全市場數據中取出指定股票並存入 DataFrame"""
+    data_frames = {}
+
+    # 三個 API 同時擷取，總耗時約等於最慢的一個；單一 API 失敗不影響其他資料
+    with ThreadPoolExecutor(max_workers=len(api_urls)) as pool:
+        futures = {key: pool.submit(_fetch_table, key) for key in api_urls}
+
+    for key, future in futures.items():
+        try:
+            rows_by_id = future.result()
         except Exception as e:
             st.error(f"擷取 {key} 資料時發生錯誤: {e}")
+            continue
+
+        rows = rows_by_id.get(stock_id)
+        if not rows:
+            continue
+
+        df = pd.DataFrame(rows)
+        df.rename(columns=required_columns, inplace=True)
+        data_frames[key] = df
 
     return data_frames
 
@@ -91,44 +237,48 @@ def merge_data(data_frames):
     if not data_frames:
         return pd.DataFrame()
 
-    # 確保 "股票代號" 欄位為字串，避免合併失敗
-    for key in data_frames:
-        if "股票代號" in data_frames[key].columns:
-            data_frames[key]["股票代號"] = data_frames[key]["股票代號"].astype(str)
-
-    # 從第一個資料框開始合併
-    merged_df = next(iter(data_frames.values()))
-    
-    # 合併其餘的資料框
-    for key, df in data_frames.items():
-        if df is not merged_df:  # 避免合併自己
-            merged_df = merged_df.merge(df, on="股票代號", how="outer")
-
-    # 處理欄位名稱重複問題
-    name_columns = [col for col in merged_df.columns if col.startswith('Name')]
-    if len(name_columns) > 0:
-        # 保留第一個 Name 欄位作為公司名稱
-        merged_df.rename(columns={name_columns[0]: "公司名稱"}, inplace=True)
-        # 刪除其他 Name 欄位
-        for col in name_columns[1:]:
-            if col in merged_df.columns:
-                merged_df.drop(columns=[col], inplace=True)
+    # 以股票代號為索引一次橫向合併，重複代號只保留最後一筆
+    frames = []
+    for df in data_frames.values():
+        frame = df.set_index("股票代號")
+        frames.append(frame[~frame.index.duplicated(keep="last")])
+    merged_df = pd.concat(frames, axis=1).reset_index()
+
+    # 處理欄位名稱重複問題，重複的欄位（包含各 API 的 Name）只保留第一個
+    merged_df = merged_df.loc[:, ~merged_df.columns.duplicated()]
+
+    # 保留下來的 Name 欄位作為公司名稱
+    merged_df.rename(columns={"Name": "公司名稱"}, inplace=True)
     
     # 將數值欄位轉換為數值型別，錯誤時填充 NaN
     numeric_cols = ["EPS", "ROE", "稅後淨利", "本益比", "殖利率", "股價淨值比", "收盤價", "月均價"]
-    for col in numeric_cols:
-        if col in merged_df.columns:
-            merged_df[col] = pd.to_numeric(merged_df[col], errors='coerce')
+    cols = [col for col in numeric_cols if col in merged_df.columns]
+    merged_df[cols] = merged_df[cols].apply(pd.to_numeric, errors='coerce')
 
     return merged_df
 
+@dataclass(slots=True)
+class Financials:
+    """單一股票整理後的財務數據"""
+    股票代號: str
+    公司名稱: str = "未知公司"
+    營業額: float = 0.0
+    稅後淨利: float = 0.0
+    EPS: float = 0.0
+    ROE: float = 0.0
+    本益比: float = 0.0
+    殖利率: float = 0.0
+    股價淨值比: float = 0.0
+    收盤價: float = 0.0
+    月均價: float = 0.0
+    missing_fields: list[str] = field(default_factory=list)
+    has_critical_errors: bool = False
+
 def extract_financial_data(df, stock_id):
     """從合併的數據中提取財務數據"""
     if df.empty:
         return None
 
-    # 確保股票代號為字串類型
-    df["股票代號"] = df["股票代號"].astype(str)
     stock_id = str(stock_id)
     
     # 檢查股票是否存在於數據中
@@ -136,22 +286,14 @@ def extract_financial_data(df, stock_id):
     if stock_data.empty:
         return None
 
-    latest_data = stock_data.iloc[-1]
-    
-    # 創建一個乾淨的資料字典
-    clean_data = {
-        "股票代號": stock_id,
-        "公司名稱": latest_data.get("公司名稱", "未知公司"),
-        "營業額": 0.0,
-        "稅後淨利": 0.0,
-        "EPS": 0.0,
-        "ROE": 0.0,
-        "本益比": 0.0,
-        "殖利率": 0.0,
-        "股價淨值比": 0.0,
-        "收盤價": 0.0,
-        "月均價": 0.0
-    }
+    # 轉為一般字典，之後的欄位查找不必經過 pandas 索引
+    latest_data = stock_data.iloc[-1].to_dict()
+    
+    # 創建一個乾淨的財務數據物件
+    clean_data = Financials(
+        股票代號=stock_id,
+        公司名稱=latest_data.get("公司名稱", "未知公司")
+    )
     
     # 欄位映射表
     field_mappings = {
@@ -168,112 +310,91 @@ def extract_financial_data(df, stock_id):
     # 處理每個欄位
     for key, possible_cols in field_mappings.items():
         for col_name in possible_cols:
-            if col_name in latest_data and pd.notna(latest_data[col_name]):
-                try:
-                    value = latest_data[col_name]
-                    # 處理字串格式的數值
-                    if isinstance(value, str):
-                        value = value.replace(',', '').replace('%', '')
-                    clean_data[key] = float(value)
-                    break  # 找到並成功轉換後跳出內部循環
-                except (ValueError, TypeError):
-                    pass
+            value = latest_data.get(col_name)
+            if value is None or pd.isna(value):
+                continue
+            try:
+                # 處理字串格式的數值
+                if isinstance(value, str):
+                    value = value.translate(_NUM_STRIP)
+                setattr(clean_data, key, float(value))
+                break  # 找到並成功轉換後跳出內部循環
+            except (ValueError, TypeError):
+                pass
     
     # 計算 ROE (如果沒有直接提供)
-    if clean_data["ROE"] == 0:
+    if clean_data.ROE == 0:
         try:
-            if clean_data["股價淨值比"] > 0 and clean_data["收盤價"] > 0:
-                book_value_per_share = clean_data["收盤價"] / clean_data["股價淨值比"]
-                if book_value_per_share > 0 and clean_data["EPS"] > 0:
-                    clean_data["ROE"] = round((clean_data["EPS"] / book_value_per_share) * 100, 2)
+            if clean_data.股價淨值比 > 0 and clean_data.收盤價 > 0:
+                book_value_per_share = clean_data.收盤價 / clean_data.股價淨值比
+                if book_value_per_share > 0 and clean_data.EPS > 0:
+                    clean_data.ROE = round((clean_data.EPS / book_value_per_share) * 100, 2)
         except Exception:
             pass
     
     # 檢查數據完整性
     missing_fields = []
-    for key, value in clean_data.items():
-        if key not in ["股票代號", "公司名稱"] and value == 0:
-            missing_fields.append(key)
+    for f in fields(clean_data):
+        if f.type is float and getattr(clean_data, f.name) == 0:
+            missing_fields.append(f.name)
     
     # 檢查資料是否有異常
-    critical_fields = ["稅後淨利", "EPS", "ROE", "收盤價"]
     has_critical_errors = False
-    for key in critical_fields:
-        if clean_data[key] <= 0:
+    for key in _CRITICAL_FIELDS:
+        if getattr(clean_data, key) <= 0:
             has_critical_errors = True
             break
     
-    clean_data["missing_fields"] = missing_fields
-    clean_data["has_critical_errors"] = has_critical_errors
+    clean_data.missing_fields = missing_fields
+    clean_data.has_critical_errors = has_critical_errors
     
     return clean_data
 
-def analyze_with_ai(financial_data, analysis_focus=None):
-    """使用 Gemini AI 進行財務數據分析"""
+@st.cache_resource
+def _get_gemini_model(model_name="gemini-1.5-pro-latest"):
+    """取得共用的 Gemini 模型實例，避免每次分析重新建立"""
+    # 使用新版本的模型名稱格式
+    return genai.GenerativeModel(model_name)
+
+def analyze_with_ai(financial_data, analysis_focus=None, force_ai=False):
+    """使用 Gemini AI 進行財務數據分析，逐段產生分析文字"""
     if not financial_data:
-        return "無法取得此股票數據，請確認股票代號是否正確。"
+        yield "無法取得此股票數據，請確認股票代號是否正確。"
+        return
     
     # 從財務數據中提取資訊
-    clean_data = financial_data.copy()
+    clean_data = asdict(financial_data)
     missing_fields = clean_data.pop("missing_fields")
     has_critical_errors = clean_data.pop("has_critical_errors")
     
     # 根據使用者選擇的分析重點調整提示詞
-    focus_prompts = {
-        "獲利": "請著重分析公司的獲利能力、ROE和EPS趨勢，評估公司的盈利品質和持續性。",
-        "風險": "請詳細評估投資風險，包括估值風險、產業風險、財務風險和地緣政治風險。特別關注本益比和股價淨值比是否合理。",
-        "成長": "請分析公司的成長潛力、未來發展機會和產業趨勢。評估公司的競爭優勢和市場擴張能力。",
-        "股利": "請著重分析公司的股利政策、殖利率表現和股利發放穩定性。評估股利成長潛力和可持續性。",
-        "積極投資": "請以積極投資者的視角分析，著重於成長機會、市場擴張潛力和可能的股價催化劑。忽略短期波動風險，專注於長期高回報可能性。提供更進取的投資建議和時機點判斷。"
-    }
-    
-    # 設定分析重點
     focus_instruction = ""
-    if analysis_focus and analysis_focus in focus_prompts:
-        focus_instruction = focus_prompts[analysis_focus]
+    if analysis_focus and analysis_focus in _FOCUS_PROMPTS:
+        focus_instruction = _FOCUS_PROMPTS[analysis_focus]
     
+    warnings = {
+        "missing_warning": f"⚠️ 注意：以下關鍵財務數據缺失或異常: {', '.join(missing_fields)}" if missing_fields else "",
+        "critical_warning": _CRITICAL_WARNING if has_critical_errors else ""
+    }
+
+    # 關鍵數據缺失時直接回傳本地摘要，不呼叫 Gemini；
+    # 虧損公司的負值屬於完整數據，仍交由 AI 分析
+    critical_missing = [key for key in _CRITICAL_FIELDS if key in missing_fields]
+    if critical_missing and not force_ai:
+        yield _INSUFFICIENT_DATA_TMPL.format_map(
+            clean_data | warnings | {"critical_missing": "、".join(critical_missing)}
+        )
+        return
+
     # 構建 AI 解析提示詞
-    market_summary = f"""
-    # 財務分析請求
-    
-    ## 公司基本資料
-    - 公司: {clean_data['公司名稱']} ({clean_data['股票代號']})
-    
-    ## 財務數據摘要
-    - 營業額: {clean_data['營業額']:,.1f} 元
-    - 稅後淨利: {clean_data['稅後淨利']:,.1f} 元
-    - 每股盈餘 (EPS): {clean_data['EPS']:.1f}
-    - 股東權益報酬率 (ROE): {clean_data['ROE']:.1f}%
-    - 本益比 (P/E Ratio): {clean_data['本益比']:.1f}
-    - 殖利率 (Dividend Yield): {clean_data['殖利率']:.1f}%
-    - 股價淨值比 (P/B Ratio): {clean_data['股價淨值比']:.1f}
-    - 收盤價: {clean_data['收盤價']:,.2f} 元
-    - 月均價: {clean_data['月均價']:,.2f} 元
-    
-    {f"⚠️ 注意：以下關鍵財務數據缺失或異常: {', '.join(missing_fields)}" if missing_fields else ""}
-    {f"⚠️ 警告：部分關鍵財務數據（如稅後淨利、EPS、ROE或收盤價）為零或異常，分析結果可能不準確。" if has_critical_errors else ""}
-    
-    ## 分析重點
-    {focus_instruction if focus_instruction else "請全面分析公司財務狀況、投資價值和風險。"}
-    
-    ## 分析要求
-    1. 請以繁體中文回覆
-    2. 請提供結構化分析報告，包含以下部分：
-       - 優勢分析
-       - 潛在風險和需注意的點
-       - 未來趨勢與投資建議
-       - 總結
-    3. 使用表情符號增加可讀性
-    4. 如果數據存在異常或缺失，請在分析中指出並解釋可能的影響
-    5. 請客觀分析，避免過度樂觀或悲觀的偏見
-    """
+    market_summary = _PROMPT_TMPL.format_map(
+        clean_data | warnings | {"focus_instruction": focus_instruction or "請全面分析公司財務狀況、投資價值和風險。"}
+    )
     
     try:
-        # 顯示分析中的提示
+        # 顯示分析中的提示，直到收到第一段回應
         with st.spinner('AI 正在分析財務數據，請稍候...'):
-            # 使用新版本的模型名稱格式
-            model_name = "gemini-1.5-pro-latest"
-            model = genai.GenerativeModel(model_name)
+            model = _get_gemini_model()
             
             # 設定生成參數
             generation_config = {
@@ -284,55 +405,142 @@ def analyze_with_ai(financial_data, analysis_focus=None):
                 "response_mime_type": "text/plain",  # 明確指定回應類型
             }
             
-            # 生成內容
+            # 以串流方式生成內容，讓使用者在模型生成時即可看到文字
             response = model.generate_content(
                 market_summary,
                 generation_config=generation_config,
-                safety_settings=[]  # 使用預設安全設定
+                safety_settings=[],  # 使用預設安全設定
+                stream=True
             )
-            
-            # 檢查回應是否成功
-            if hasattr(response, 'text') and response.text:
-                return response.text
-            elif hasattr(response, 'parts') and response.parts:
-                return response.parts[0].text
-            else:
-                return "AI 無法生成回應，請稍後再試。"
+
+        # 檢查回應是否成功
+        has_output = False
+        for chunk in response:
+            if chunk.parts:
+                has_output = True
+                yield chunk.text
+
+        if not has_output:
+            yield "AI 無法生成回應，請稍後再試。"
 
     except Exception as e:
-        return f"AI 分析發生錯誤: {str(e)}"
+        yield f"AI 分析發生錯誤: {str(e)}"
 
 def display_welcome():
     """顯示歡迎訊息和使用說明"""
     st.title("📊 台股 AI 分析工具")
     
-    st.markdown("""
-    ### 👋 歡迎使用台股 AI 分析工具！
+    # 查詢過後收合使用說明，讓版面聚焦在分析結果
+    with st.expander("使用說明", expanded=not st.session_state.get("analyzed")):
+        st.markdown("""
+        ### 👋 歡迎使用台股 AI 分析工具！
+
+        這個工具能幫助您快速分析台灣上市公司的財務狀況，並提供 AI 生成的投資建議。
+
+        #### 📝 使用方法：
+        1. 在下方輸入框中輸入股票代號（例如：2330）
+        2. 選擇您希望的分析重點
+        3. 點擊「分析」按鈕
+        4. 查看 AI 生成的分析報告
 
-    這個工具能幫助您快速分析台灣上市公司的財務狀況，並提供 AI 生成的投資建議。
+        #### ✨ 功能特點：
+        - 自動擷取最新財務數據
+        - 多種分析重點可選
+        - AI 智能分析投資價值
+        - 結構化報告一目了然
 
-    #### 📝 使用方法：
-    1. 在下方輸入框中輸入股票代號（例如：2330）
-    2. 選擇您希望的分析重點
-    3. 點擊「分析」按鈕
-    4. 查看 AI 生成的分析報告
+        #### ⚠️ 注意事項：
+        - 分析結果僅供參考，不構成投資建議
+        - 部分股票可能因數據缺失而無法完整分析
+        - 請自行判斷投資風險
+        """)
 
-    #### ✨ 功能特點：
-    - 自動擷取最新財務數據
-    - 多種分析重點可選
-    - AI 智能分析投資價值
-    - 結構化報告一目了然
+@st.cache_data(max_entries=32)
+def _df_to_csv(df) -> bytes:
+    """將合併後的數據轉為 CSV，數據未變動時沿用快取避免重新序列化"""
+    return df.to_csv(index=False).encode()
+
+@st.fragment
+def _render_analysis(financial_data, merged_df, stock_id, analysis_focus, force_ai):
+    """顯示分析結果，區塊內的互動只重新執行此區塊"""
+    # 顯示財務數據摘要
+    st.subheader("📊 財務數據摘要")
+    
+    # 使用兩欄佈局顯示財務數據
+    col1, col2 = st.columns(2)
+    
+    with col1:
+        st.info(f"**公司**: {financial_data.公司名稱} ({financial_data.股票代號})")
+        st.metric("營業額", f"{financial_data.營業額:,.1f} 元")
+        st.metric("稅後淨利", f"{financial_data.稅後淨利:,.1f} 元")
+        st.metric("每股盈餘 (EPS)", f"{financial_data.EPS:.1f}")
+        st.metric("股東權益報酬率 (ROE)", f"{financial_data.ROE:.1f}%")
+    
+    with col2:
+        st.metric("本益比 (P/E Ratio)", f"{financial_data.本益比:.1f}")
+        st.metric("殖利率 (Dividend Yield)", f"{financial_data.殖利率:.1f}%")
+        st.metric("股價淨值比 (P/B Ratio)", f"{financial_data.股價淨值比:.1f}")
+        st.metric("收盤價", f"{financial_data.收盤價:,.2f} 元")
+        st.metric("月均價", f"{financial_data.月均價:,.2f} 元")
+    
+    # 顯示警告訊息（如果有）
+    if financial_data.missing_fields:
+        st.warning(f"⚠️ 注意：以下關鍵財務數據缺失或異常: {', '.join(financial_data.missing_fields)}")
+    
+    if financial_data.has_critical_errors:
+        st.error(_CRITICAL_WARNING)
+    
+    # 執行 AI 分析並逐段顯示分析結果，區塊重新執行時沿用已產生的報告
+    st.subheader("📝 AI 分析報告")
+    if "analysis_report" in st.session_state:
+        st.markdown(st.session_state["analysis_report"])
+    else:
+        st.session_state["analysis_report"] = st.write_stream(
+            analyze_with_ai(financial_data, _FOCUS_MAPPING[analysis_focus], force_ai)
+        )
+    
+    # 提供下載數據的選項
+    st.download_button(
+        label="下載財務數據 (CSV)",
+        data=_df_to_csv(merged_df),
+        file_name=f"stock_analysis_{stock_id}.csv",
+        mime="text/csv",
+    )
 
-    #### ⚠️ 注意事項：
-    - 分析結果僅供參考，不構成投資建議
-    - 部分股票可能因數據缺失而無法完整分析
-    - 請自行判斷投資風險
-    """)
+def _load_stock(stock_id):
+    """擷取、合併並提取單一股票的財務數據，失敗時顯示錯誤並回傳 None"""
+    # 顯示處理中的提示
+    with st.spinner('正在擷取財務數據...'):
+        # 擷取數據
+        data_frames = fetch_data(stock_id)
+        
+        if not data_frames:
+            st.error("無法取得數據，請確認股票代號是否正確。")
+            return None
+        
+        # 合併數據
+        merged_df = merge_data(data_frames)
+        
+        if merged_df.empty:
+            st.error("合併數據失敗，請確認股票代號是否正確。")
+            return None
+        
+        # 提取財務數據
+        financial_data = extract_financial_data(merged_df, stock_id)
+        
+        if not financial_data:
+            st.error("無法提取財務數據，請確認股票代號是否正確。")
+            return None
+    
+    # 成功查詢後收合使用說明
+    st.session_state["analyzed"] = True
+    
+    return financial_data, merged_df
 
 def main():
     """主函數，處理整個分析流程"""
-    # 顯示歡迎訊息
-    display_welcome()
+    # 預留頁面頂端的歡迎訊息位置
+    welcome = st.container()
     
     # 側邊欄 - 分析選項
     st.sidebar.title("分析選項")
@@ -341,16 +549,10 @@ def main():
         ["全面分析", "獲利", "風險", "成長", "股利", "積極投資"],
         index=0
     )
-    
-    # 將選項映射到API參數
-    focus_mapping = {
-        "全面分析": None,
-        "獲利": "獲利",
-        "風險": "風險",
-        "成長": "成長",
-        "股利": "股利",
-        "積極投資": "積極投資"
-    }
+    force_ai = st.sidebar.checkbox(
+        "仍要AI分析",
+        help="關鍵財務數據缺失時，預設不進行 AI 分析"
+    )
     
     # 主畫面 - 股票查詢
     with st.form("stock_analysis_form"):
@@ -358,75 +560,22 @@ def main():
         submit_button = st.form_submit_button("分析")
     
     # 當使用者提交查詢
+    loaded = None
     if submit_button and stock_id:
         # 清除股票代號中的空白字元
         stock_id = stock_id.strip()
+        loaded = _load_stock(stock_id)
+    
+    # 擷取數據後才繪製歡迎訊息，首次成功查詢即可收合使用說明
+    with welcome:
+        display_welcome()
+    
+    if loaded:
+        financial_data, merged_df = loaded
         
-        # 顯示處理中的提示
-        with st.spinner('正在擷取財務數據...'):
-            # 擷取數據
-            data_frames = fetch_data(stock_id)
-            
-            if not data_frames:
-                st.error("無法取得數據，請確認股票代號是否正確。")
-                return
-            
-            # 合併數據
-            merged_df = merge_data(data_frames)
-            
-            if merged_df.empty:
-                st.error("合併數據失敗，請確認股票代號是否正確。")
-                return
-            
-            # 提取財務數據
-            financial_data = extract_financial_data(merged_df, stock_id)
-            
-            if not financial_data:
-                st.error("無法提取財務數據，請確認股票代號是否正確。")
-                return
-        
-        # 顯示財務數據摘要
-        st.subheader("📊 財務數據摘要")
-        
-        # 使用兩欄佈局顯示財務數據
-        col1, col2 = st.columns(2)
-        
-        with col1:
-            st.info(f"**公司**: {financial_data['公司名稱']} ({financial_data['股票代號']})")
-            st.metric("營業額", f"{financial_data['營業額']:,.1f} 元")
-            st.metric("稅後淨利", f"{financial_data['稅後淨利']:,.1f} 元")
-            st.metric("每股盈餘 (EPS)", f"{financial_data['EPS']:.1f}")
-            st.metric("股東權益報酬率 (ROE)", f"{financial_data['ROE']:.1f}%")
-        
-        with col2:
-            st.metric("本益比 (P/E Ratio)", f"{financial_data['本益比']:.1f}")
-            st.metric("殖利率 (Dividend Yield)", f"{financial_data['殖利率']:.1f}%")
-            st.metric("股價淨值比 (P/B Ratio)", f"{financial_data['股價淨值比']:.1f}")
-            st.metric("收盤價", f"{financial_data['收盤價']:,.2f} 元")
-            st.metric("月均價", f"{financial_data['月均價']:,.2f} 元")
-        
-        # 顯示警告訊息（如果有）
-        if financial_data["missing_fields"]:
-            st.warning(f"⚠️ 注意：以下關鍵財務數據缺失或異常: {', '.join(financial_data['missing_fields'])}")
-        
-        if financial_data["has_critical_errors"]:
-            st.error("⚠️ 警告：部分關鍵財務數據（如稅後淨利、EPS、ROE或收盤價）為零或異常，分析結果可能不準確。")
-        
-        # 執行 AI 分析
-        analysis_result = analyze_with_ai(financial_data, focus_mapping[analysis_focus])
-        
-        # 顯示分析結果
-        st.subheader("📝 AI 分析報告")
-        st.markdown(analysis_result)
-        
-        # 提供下載數據的選項
-        csv = merged_df.to_csv(index=False)
-        st.download_button(
-            label="下載財務數據 (CSV)",
-            data=csv,
-            file_name=f"stock_analysis_{stock_id}.csv",
-            mime="text/csv",
-        )
+        # 顯示分析結果，新的查詢需重新產生 AI 報告
+        st.session_state.pop("analysis_report", None)
+        _render_analysis(financial_data, merged_df, stock_id, analysis_focus, force_ai)
     
     # 顯示頁腳
     st.markdown("---")